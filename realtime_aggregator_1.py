@@ -5,43 +5,70 @@ Author: Makoto Ono
 """
 
 from sedona.spark import *
-from pyspark.sql.types import IntegerType, ArrayType
+from pyspark.sql.types import StructType, ArrayType
 from realtime_predictor import RealTimePredictor
 from utils.datapreprocessing_utils import *
 from pyspark.sql import functions as F
-from pyspark.sql import DataFrame
+from pyspark.sql import Column, DataFrame, SparkSession
+
+
+_SEDONA = None
+
+
+def get_sedona() -> SparkSession:
+    """
+    Create the Sedona context on the first call and reuse it afterwards
+
+    Returns
+    --------
+    sedona: SparkSession with Sedona registered
+    """
+    global _SEDONA
+    if _SEDONA is None:
+        config = SedonaContext.builder() \
+            .master("local[*]") \
+            .appName("SedonaSample") \
+            .config('spark.jars.packages', 
+                    'org.apache.sedona:sedona-spark-3.5_2.12:1.6.0,'
+                    'org.datasyslab:geotools-wrapper:1.6.0-28.2,'
+                    'org.apache.spark:spark-sql-kafka-0-10_2.12:3.5.0,'
+                    'org.apache.kafka:kafka-clients:3.8.0,'
+                    'org.apache.spark:spark-token-provider-kafka-0-10_2.12:3.5.0,'
+                    ) \
+            .config('spark.sql.streaming.statefulOperator.checkCorrectness.enabled', 'false') \
+            .getOrCreate()
+        _SEDONA = SedonaContext.create(config)
+        print("Sedona Initialized")
+    return _SEDONA
 
 
 class FirstWatermarkAggregator(RealTimePredictor):
     def __init__(self):
         super().__init__()
+        self.trigger_interval = f"{self.timewindow} seconds" # one micro-batch per timewindow
 
-    def parse_df(self, df: DataFrame) -> DataFrame:
+    def parse_and_bucket(self, df: DataFrame) -> DataFrame:
         """
-        Parse the dataframe containing a json object
+        Parse the dataframe containing a json object and give a Section ID to each datapoint in a single projection
 
         Returns
         --------
-        df: pyspark dataframe containing the parsed values of the json object in each column
+        df: pyspark dataframe containing Global_Time, Lane_ID, v_Vel, and Section_ID columns
         """
+        # each kafka message is a json array of records, so only parse the fields used downstream before exploding
+        record_schema = StructType([get_test_record_schema()[field] for field in ["Global_Time", "Local_X", "Local_Y", "v_Vel", "Lane_ID"]])
+        distance = F.sqrt(F.col("p.Local_X") * F.col("p.Local_X") + F.col("p.Local_Y") * F.col("p.Local_Y"))
+
         return df \
             .select(
-                F.from_json(F.col("value").cast("string"), schema=get_test_schema()).alias("parsed_value")
+                F.explode(F.from_json(F.col("value").cast("string"), schema=ArrayType(record_schema))).alias("p")
             ) \
-            .select('*', F.inline("parsed_value")).drop("parsed_value", "v_Acc") 
-
-    def add_dist(self, df: DataFrame) -> DataFrame:
-        """
-        Add a new column Distance to the dataframe and drop Local_X and Local_Y columns
-
-        Returns
-        --------
-        df: pyspark dataframe containing the additional Distance column.
-        """
-        return df.withColumns({
-            "Distance": F.sqrt(F.pow(F.col("Local_X"), 2) + F.pow(F.col("Local_Y"), 2))
-            }) \
-            .drop("Local_X", "Local_Y") 
+            .select(
+                "p.Global_Time", 
+                "p.Lane_ID", 
+                "p.v_Vel", 
+                bucket_id(distance, self.max_dist // self.num_section_splits).alias("Section_ID") # gives a Section ID to each datapoint 
+            )
 
     def section_agg(self, df: DataFrame) -> DataFrame:
         """
@@ -52,18 +79,11 @@ class FirstWatermarkAggregator(RealTimePredictor):
         df: pyspark dataframe containing the aggregated values of avg(v_Vel)
             grouped by timestamp, Section_ID, and Lane_ID
         """
-        df = df \
-            .withColumn("Section_ID", 
-                F.round(
-                    (F.col("Distance") / F.lit(self.max_dist // self.num_section_splits)).cast("integer")
-                ) # gives a Section ID to each datapoint 
-            ) \
-            .select("Global_Time", "Lane_ID", "v_Vel", "Section_ID") \
+        return df \
             .groupBy("Global_Time", "Section_ID", "Lane_ID") \
             .agg(
                 F.avg("v_Vel").alias("avg(v_Vel)"),
             )
-        return df
     
     def timewindow_agg(self, df: DataFrame) -> DataFrame:
         """
@@ -75,11 +95,12 @@ class FirstWatermarkAggregator(RealTimePredictor):
             grouped by timewindow, Section_ID, and Lane_ID
         """
 
-        return convert_timestamp(df) \
-            .withWatermark("datetime", f"{self.timewindow} second") \
+        return df \
+            .withColumn("event_ts", F.timestamp_millis(F.col("Global_Time") - 3600000)) \
+            .withWatermark("event_ts", f"{self.timewindow} second") \
             .groupBy(
                 F.window(
-                    F.col("datetime"), 
+                    F.col("event_ts"), 
                     f"{self.timewindow} second"
                 ).alias("timewindow"),
                 "Section_ID", 
@@ -91,50 +112,38 @@ class FirstWatermarkAggregator(RealTimePredictor):
     
     def rows_to_np_df(self, df: DataFrame) -> DataFrame:
         """
-        Convert the aggregated rows to a 3D array and store it in a dataframe column
+        Convert the aggregated rows to a 3D array and store it in a dataframe column.
+        Lanes and sections are pivoted natively with one conditional aggregate per cell,
+        since DataFrame.pivot is not supported on streaming dataframes
 
         Returns
         --------
-        df: pyspark dataframe containing the 3D numpy array column
+        df: pyspark dataframe containing the 3D float array column (num_lanes, num_sections, 1)
         """
-
-        def to_3d_np(rows):
-            vel_matrix = np.full((self.num_lanes, self.num_section_splits + 1), 60)
-            for row in rows:
-                lane_index = row["Lane_ID"] - 1
-                if not self.with_ramp and lane_index == 5:
-                    continue
-                section_index = row["Section_ID"] - 1 if row["Section_ID"] == self.num_section_splits + 1 else row["Section_ID"]
-                vel_matrix[lane_index][section_index] = row["avg(v_Vel)"]
-            return np.expand_dims(vel_matrix, axis=-1).tolist()
-
-        to_3d_np_udf = F.udf(to_3d_np, ArrayType(ArrayType(ArrayType(IntegerType()))))
+        section_index = F.least(F.col("Section_ID"), F.lit(self.num_section_splits)) # merge the last section into the previous one
+        lane_ids = [lane_id for lane_id in range(1, self.num_lanes + 1) if self.with_ramp or lane_id != 6]
+
+        def cell(lane_id: int, section_id: int) -> Column:
+            return F.coalesce(
+                F.last(
+                    F.when((F.col("Lane_ID") == lane_id) & (section_index == section_id), F.col("avg(v_Vel)")), 
+                    ignorenulls=True
+                ), # the latest revised average wins, as timewindow_agg re-emits rows on every trigger
+                F.lit(60) # fill with 60 mph
+            ).cast("float")
 
         return df \
             .groupBy("timewindow") \
-            .agg(   
-                F.collect_list(
-                    F.struct("Lane_ID", "Section_ID", "avg(v_Vel)")
-                ).alias("rows")
+            .agg(
+                F.array(*[
+                    F.array(*[F.array(cell(lane_id, section_id)) for section_id in range(self.num_sections)])
+                    for lane_id in lane_ids
+                ]).alias("3D_mat")
             ) \
-            .withColumn("3D_mat", to_3d_np_udf(F.col('rows'))) \
             .select("timewindow", "3D_mat")
     
     def init_job(self):
-        config = SedonaContext.builder() \
-            .master("local[*]") \
-            .appName("SedonaSample") \
-            .config('spark.jars.packages', 
-                    'org.apache.sedona:sedona-spark-3.5_2.12:1.6.0,'
-                    'org.datasyslab:geotools-wrapper:1.6.0-28.2,'
-                    'org.apache.spark:spark-sql-kafka-0-10_2.12:3.5.0,'
-                    'org.apache.kafka:kafka-clients:3.8.0,'
-                    'org.apache.spark:spark-token-provider-kafka-0-10_2.12:3.5.0,'
-                    ) \
-            .config('spark.sql.streaming.statefulOperator.checkCorrectness.enabled', 'false') \
-            .getOrCreate()
-        sedona = SedonaContext.create(config)
-        print("Sedona Initialized")
+        sedona = get_sedona()
 
         df = sedona.readStream \
             .format('kafka') \
@@ -143,9 +152,8 @@ class FirstWatermarkAggregator(RealTimePredictor):
             .option('startingOffsets', 'earliest') \
             .load()
 
-        parsed_df = self.parse_df(df)
-        dist_added_df = self.add_dist(parsed_df)
-        section_agg_df = self.section_agg(dist_added_df)
+        parsed_df = self.parse_and_bucket(df)
+        section_agg_df = self.section_agg(parsed_df)
         timewindow_agg_df = self.timewindow_agg(section_agg_df)
         np_df = self.rows_to_np_df(timewindow_agg_df)
 
@@ -158,8 +166,11 @@ class FirstWatermarkAggregator(RealTimePredictor):
             .option("kafka.bootstrap.servers", self.bootstrap_servers) \
             .option("topic", "us101_agg1") \
             .option("checkpointLocation", "checkpoints/FirstWatermarkAggregator") \
+            .trigger(processingTime=self.trigger_interval) \
             .start()
 
         query.awaitTermination()
 
-FirstWatermarkAggregator().init_job()
\ No newline at end of file
+
+if __name__ == "__main__":
+    FirstWatermarkAggregator().init_job()
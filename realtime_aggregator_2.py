@@ -5,7 +5,7 @@ Author: Makoto Ono
 """
 
 from sedona.spark import *
-from pyspark.sql.types import StructType, StructField, IntegerType, TimestampType, ArrayType
+from pyspark.sql.types import StructType, StructField, IntegerType, FloatType, TimestampType, ArrayType
 from realtime_predictor import RealTimePredictor
 from pyspark.sql import functions as F
 from pyspark.sql import DataFrame
@@ -31,7 +31,7 @@ class SecondWatermarkAggregator(RealTimePredictor):
                     StructField("end", TimestampType(), False)
                 ]))
             ])
-        value_schema = ArrayType(ArrayType(ArrayType(IntegerType(), False), False), False)
+        value_schema = ArrayType(ArrayType(ArrayType(FloatType(), False), False), False)
 
         return df \
             .select(
@@ -92,7 +92,7 @@ class SecondWatermarkAggregator(RealTimePredictor):
             if len(input) != self.history_len: # if there is not enough received data to predict
                 return np.zeros((self.num_lanes, self.num_sections), dtype=int).tolist()
             
-            input_mat = np.reshape(np.array(input), (1, self.history_len, self.num_lanes, self.num_sections, self.num_features))
+            input_mat = np.reshape(np.array(input, dtype=np.float32), (1, self.history_len, self.num_lanes, self.num_sections, self.num_features))
             pred = self.model.predict(input_mat)
             round_pred = np.rint(pred).astype(int)
             return round_pred.reshape(self.num_lanes, self.num_sections).tolist()
@@ -102,7 +102,7 @@ class SecondWatermarkAggregator(RealTimePredictor):
         return df \
             .withColumns({
                 "prediction": pred_udf(F.col("sorted_4D_mat")),
-                "Global_Time": F.unix_timestamp(F.to_utc_timestamp(F.col("based_timewindow.start"), 'America/Los_Angeles')) + 3600000
+                "Global_Time": F.unix_timestamp(F.col("based_timewindow.start")) + 3600000
             }) \
             .select(F.col("based_timewindow"), F.col("Global_Time"), F.col("prediction")) \
         
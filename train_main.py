@@ -20,6 +20,7 @@ config = SedonaContext.builder() \
             'org.apache.sedona:sedona-spark-3.5_2.12:1.6.0,'
             'org.datasyslab:geotools-wrapper:1.6.0-28.2'
         ) \
+    .config('spark.sql.execution.arrow.pyspark.enabled', 'true') \
     .getOrCreate()
 sedona = SedonaContext.create(config)
 print("Sedona Initialized")
@@ -30,7 +31,7 @@ end = 2229.5 if realtime_mode else 2772.5 # after splitting the test and train d
 predict_len = 1
 
 def check_max_elapsed_time(df):
-    max_elapsed_time = df.select("ElapsedTime").tail(1)[0]["ElapsedTime"]
+    max_elapsed_time = df.agg(F.max("ElapsedTime")).collect()[0][0]
     print(f"Max Elapsed Time: {max_elapsed_time}")
     return max_elapsed_time
 
@@ -3,9 +3,8 @@ This file contains a bunch of utility functions that are used to preprocess the
 
 Author: Makoto Ono
 """
+import threading
 import pyspark
-from sedona.sql.st_functions import ST_Transform, ST_Y, ST_X
-from sedona.sql.st_constructors import ST_Point
 from pyspark.sql import functions as F
 from pyspark.sql import DataFrame
 import numpy as np
@@ -13,6 +12,9 @@ import torch
 from pyspark.sql.types import StructType, StructField, IntegerType, LongType, DoubleType, StringType, ArrayType
 
 
+_transformers = threading.local() # pyproj transformers are not thread-safe, so cache one per thread
+
+
 def get_original_schema() -> pyspark.sql.types.StructType:
     return StructType([
         StructField("Vehicle_ID", IntegerType(), True),
@@ -42,22 +44,23 @@ def get_original_schema() -> pyspark.sql.types.StructType:
         StructField("Location", StringType(), True)
     ])
 
-def get_test_schema() -> pyspark.sql.types.StructType:
-    return ArrayType(
-                StructType([
-                    StructField("Global_Time", LongType(), False),
-                    StructField("ElapsedTime", LongType(), False),
-                    StructField("Vehicle_ID", IntegerType(), False),
-                    StructField("Global_X", DoubleType(), False),
-                    StructField("Global_Y", DoubleType(), False),
-                    StructField("Local_X", DoubleType(), False),
-                    StructField("Local_Y", DoubleType(), False),
-                    StructField("v_Vel", DoubleType(), False),
-                    StructField("v_Acc", DoubleType(), False),
-                    StructField("Lane_ID", IntegerType(), False),
-                    StructField("Location", StringType(), False), 
-                ])
-            )
+def get_test_record_schema() -> pyspark.sql.types.StructType:
+    return StructType([
+        StructField("Global_Time", LongType(), False),
+        StructField("ElapsedTime", LongType(), False),
+        StructField("Vehicle_ID", IntegerType(), False),
+        StructField("Global_X", DoubleType(), False),
+        StructField("Global_Y", DoubleType(), False),
+        StructField("Local_X", DoubleType(), False),
+        StructField("Local_Y", DoubleType(), False),
+        StructField("v_Vel", DoubleType(), False),
+        StructField("v_Acc", DoubleType(), False),
+        StructField("Lane_ID", IntegerType(), False),
+        StructField("Location", StringType(), False), 
+    ])
+
+def get_test_schema() -> pyspark.sql.types.ArrayType:
+    return ArrayType(get_test_record_schema())
 
 def convert_to_mph(df: DataFrame) -> DataFrame:
     """
@@ -69,22 +72,47 @@ def convert_to_mph(df: DataFrame) -> DataFrame:
     """
     return df.withColumns({"v_Vel": F.col("v_Vel") / 1.46666667, "v_Acc": F.col("v_Acc") / 1.46666667})         
 
+def get_transformer(src_crs: str, dst_crs: str):
+    """
+    src_crs: str, source coordinate reference system
+    dst_crs: str, destination coordinate reference system
+
+    Returns
+    -------
+    transformer: pyproj Transformer from src_crs to dst_crs, created once per thread and reused
+    """
+    from pyproj import Transformer # only needed where coordinates are reprojected
+
+    if not hasattr(_transformers, "cache"):
+        _transformers.cache = {}
+    if (src_crs, dst_crs) not in _transformers.cache:
+        _transformers.cache[(src_crs, dst_crs)] = Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+    return _transformers.cache[(src_crs, dst_crs)]
+
 def convert_coordinate_system(df: DataFrame) -> DataFrame:
     """
     df: pyspark dataframe containing the US101 dataset
     
     Returns
     -------
-    df: pyspark dataframe containing the converted coordinate system
+    df: pyspark dataframe containing the converted coordinate system (requires pyproj and pyarrow)
     """
+    import pandas as pd
+
+    @F.pandas_udf(StructType([StructField("lat", DoubleType()), StructField("lon", DoubleType())]))
+    def to_gps_udf(x: pd.Series, y: pd.Series) -> pd.DataFrame:
+        # transform the whole Arrow batch from EPSG:2227 to EPSG:4326 at once
+        lon, lat = get_transformer("EPSG:2227", "EPSG:4326").transform(x.to_numpy(), y.to_numpy())
+        return pd.DataFrame({"lat": lat, "lon": lon})
+
     df = df \
-        .withColumn("geometry", ST_Point(df["Global_X"], df["Global_Y"])) \
-        .withColumn("gps_geom", ST_Transform("geometry", F.lit("EPSG:2227"), F.lit("EPSG:4326"))) \
-        .drop("Global_X", "Global_Y", "geometry") \
+        .withColumn("gps", to_gps_udf("Global_X", "Global_Y")) \
+        .drop("Global_X", "Global_Y") \
         .withColumns({
-            "lat": ST_Y("gps_geom"),
-            "lon": ST_X("gps_geom")
-        })
+            "lat": F.col("gps.lat"),
+            "lon": F.col("gps.lon")
+        }) \
+        .drop("gps")
     return df
 
 def convert_timestamp(df: DataFrame) -> DataFrame:
@@ -111,7 +139,7 @@ def add_distance_and_time_cols(df: DataFrame) -> DataFrame:
     df: pyspark dataframe containing the data of Distance and ElapsedTime
     """
     return df.withColumns({
-            "Distance": F.sqrt(F.pow(F.col("Local_X"), 2) + F.pow(F.col("Local_Y"), 2)),
+            "Distance": F.sqrt(F.col("Local_X") * F.col("Local_X") + F.col("Local_Y") * F.col("Local_Y")),
             "ElapsedTime": F.col("Global_Time") - 1113433135300 # subtract the first timestamp of the whole dataset (including other locations) to get the elapsed time
         })
 
@@ -140,12 +168,12 @@ def hour_filter(df: DataFrame, location: str, hour: list) -> DataFrame:
 
     Returns
     -------
-    df: pyspark dataframe containing the data of Location, ElapsedTime, hour, Distance, Vehicle_ID, Lane_ID, v_Vel, v_Acc, lat, lon, sorted by ElapsedTime
+    df: pyspark dataframe containing the data of Location, ElapsedTime, hour, Distance, Vehicle_ID, Lane_ID, v_Vel, v_Acc, lat, lon
     """
     if location == "us-101":
         deduction = 5413844400 # subtract the first timestamp of the us-101 dataset
 
-    filtered_df= df.filter((F.col("hour").isin(hour))).sort("datetime") \
+    filtered_df= df.filter((F.col("hour").isin(hour))) \
             .select(
                 "Location", 
                 "ElapsedTime", 
@@ -157,8 +185,7 @@ def hour_filter(df: DataFrame, location: str, hour: list) -> DataFrame:
                 "v_Acc",  
                 "lat", 
                 "lon") \
-            .withColumn("ElapsedTime", F.col("ElapsedTime") - deduction) \
-            .sort("ElapsedTime")
+            .withColumn("ElapsedTime", F.col("ElapsedTime") - deduction)
         
     print(f"{location} {hour}h Data Filtered")
     return filtered_df
@@ -177,8 +204,7 @@ def lane_filter(df: DataFrame, lane_id: int) -> DataFrame:
         .select("Location", "ElapsedTime", "hour", "Distance", "Vehicle_ID", "Lane_ID", "v_Vel", "v_Acc") \
         .filter(
             (F.col("Lane_ID") == lane_id)
-        ) \
-        .sort("ElapsedTime")
+        )
 
 def create_np_matrices(df: DataFrame, num_lanes: int, num_sections: int, with_ramp: bool = True) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
@@ -190,29 +216,24 @@ def create_np_matrices(df: DataFrame, num_lanes: int, num_sections: int, with_ra
     matrices: tuple of three 2D numpy arrays (num_lanes, num_section+1) containing the avg(v_Vel), count, and avg(v_Acc) values
     """
 
-    vel_matrix = np.full((num_lanes, num_sections), 60) # fill with 60 mph 
+    vel_matrix = np.full((num_lanes, num_sections), 60, dtype=np.float32) # fill with 60 mph 
     dens_matrix = np.zeros((num_lanes, num_sections))
     acc_matrix = np.zeros((num_lanes, num_sections))
 
-    # Fill the matrix with the corresponding avg(v_Vel) values
-    for row in df.collect():
-        lane_index = row["Lane_ID"]
-
-        # escape when with_ramp is False and lane_id is 6 (lane_index is 5)
-        if not with_ramp and lane_index == 6: 
-            continue
+    # Fetch the columns at once (Arrow-backed when spark.sql.execution.arrow.pyspark.enabled is set)
+    pdf = df.select("Lane_ID", "Section_ID", "avg(v_Vel)", "count", "avg(v_Acc)").toPandas()
 
-        section_index = row["Section_ID"]
-        avg_vel = row["avg(v_Vel)"]
-        count = row["count"]
-        avg_acc = row["avg(v_Acc)"]
+    # escape when with_ramp is False and lane_id is 6 (lane_index is 5)
+    if not with_ramp:
+        pdf = pdf[pdf["Lane_ID"] != 6]
 
-        if section_index == num_sections:
-            section_index = num_sections - 1
+    lane_index = pdf["Lane_ID"].to_numpy() - 1
+    section_index = np.minimum(pdf["Section_ID"].to_numpy(), num_sections - 1)
 
-        vel_matrix[lane_index-1][section_index] = avg_vel
-        dens_matrix[lane_index-1][section_index] = count
-        acc_matrix[lane_index-1][section_index] = avg_acc
+    # Fill the matrix with the corresponding avg(v_Vel) values
+    vel_matrix[lane_index, section_index] = pdf["avg(v_Vel)"].to_numpy()
+    dens_matrix[lane_index, section_index] = pdf["count"].to_numpy()
+    acc_matrix[lane_index, section_index] = pdf["avg(v_Acc)"].to_numpy()
     
     return vel_matrix, dens_matrix, acc_matrix
 
@@ -249,29 +270,26 @@ def rdd_to_np_matrices(key: int, iter, num_lanes: int, num_sections: int, scale:
         # return (x - scale[f"min({col})"]) / (scale[f"max({col})"] - scale[f"min({col})"])
 
     # Create an empty matrix with the dimensions of Section_ID and Lane_ID
-    vel_matrix = np.full((num_lanes, num_sections), min_max_scaler(60, "avg(v_Vel)")) # fill with 60 mph 
+    vel_matrix = np.full((num_lanes, num_sections), min_max_scaler(60, "avg(v_Vel)"), dtype=np.float32) # fill with 60 mph 
     dens_matrix = np.zeros((num_lanes, num_sections))
     acc_matrix = np.zeros((num_lanes, num_sections))
 
-    # Fill the matrix with the corresponding avg(v_Vel) values
-    for row in iter:
-        lane_index = row["Lane_ID"]
-
-        # escape when with_ramp is False and lane_id is 6 (lane_index is 5)
-        if not with_ramp and lane_index == 6: 
-            continue
+    rows = np.fromiter(
+        ((row["Lane_ID"], row["Section_ID"], row["avg(v_Vel)"], row["count"], row["avg(v_Acc)"]) for row in iter),
+        dtype=[("lane_id", np.int64), ("section_id", np.int64), ("avg_vel", np.float64), ("count", np.int64), ("avg_acc", np.float64)]
+    )
 
-        section_index = row["Section_ID"]
-        avg_vel = row["avg(v_Vel)"]
-        count = row["count"]
-        avg_acc = row["avg(v_Acc)"]
+    # escape when with_ramp is False and lane_id is 6 (lane_index is 5)
+    if not with_ramp:
+        rows = rows[rows["lane_id"] != 6]
 
-        if section_index == num_sections:
-            section_index = num_sections - 1
+    lane_index = rows["lane_id"] - 1
+    section_index = np.minimum(rows["section_id"], num_sections - 1)
 
-        vel_matrix[lane_index-1][section_index] = min_max_scaler(avg_vel, "avg(v_Vel)")
-        dens_matrix[lane_index-1][section_index] = min_max_scaler(count, "count") 
-        acc_matrix[lane_index-1][section_index] = min_max_scaler(avg_acc, "avg(v_Acc)")
+    # Fill the matrix with the corresponding avg(v_Vel) values
+    vel_matrix[lane_index, section_index] = min_max_scaler(rows["avg_vel"], "avg(v_Vel)")
+    dens_matrix[lane_index, section_index] = min_max_scaler(rows["count"], "count") 
+    acc_matrix[lane_index, section_index] = min_max_scaler(rows["avg_acc"], "avg(v_Acc)")
 
     matrices = np.stack([vel_matrix, dens_matrix, acc_matrix], axis=-1)
     return key, matrices
@@ -279,6 +297,17 @@ def rdd_to_np_matrices(key: int, iter, num_lanes: int, num_sections: int, scale:
     #return key, np.expand_dims(vel_matrix, axis=-1)
 
 
+def bucket_id(col: pyspark.sql.Column, width: float) -> pyspark.sql.Column:
+    """
+    col: pyspark column to bucket
+    width: float, width of each bucket
+
+    Returns
+    -------
+    col: integer pyspark column containing floor(col / width)
+    """
+    return F.floor(col * F.lit(1 / width)).cast(IntegerType()) # multiply by the reciprocal instead of dividing each row
+
 def section_agg(df: DataFrame, max_dist: int, num_section_splits: int) -> DataFrame:
     """
     df: pyspark dataframe containing the US101 dataset
@@ -292,9 +321,7 @@ def section_agg(df: DataFrame, max_dist: int, num_section_splits: int) -> DataFr
     """
     df = df \
         .withColumn("Section_ID", 
-            F.round(
-                (F.col("Distance") / F.lit(max_dist // num_section_splits)).cast("integer")
-            ) # gives a Section ID to each datapoint 
+            bucket_id(F.col("Distance"), max_dist // num_section_splits) # gives a Section ID to each datapoint 
         ) \
         .select("ElapsedTime", "Lane_ID", "v_Vel", "v_Acc", "Section_ID") \
         .groupBy("ElapsedTime", "Section_ID", "Lane_ID") \
@@ -319,8 +346,8 @@ def timewindow_agg(df: DataFrame, start: int, end: int, timewindow: int) -> Data
     """
     df = df \
         .filter((F.col("ElapsedTime") >= start * 1000) & (F.col("ElapsedTime") < end * 1000 - 45)) \
-        .withColumn("TimeWindow",                                                       # subtract 45 seconds to remove the last incomplete trajectories
-            F.round((F.col("ElapsedTime") / F.lit(timewindow * 1000)).cast("integer")) # gives a TimeWindow ID of every 30 sec to each datapoint 
+        .withColumn("TimeWindow",                              # subtract 45 seconds to remove the last incomplete trajectories
+            bucket_id(F.col("ElapsedTime"), timewindow * 1000) # gives a TimeWindow ID of every 30 sec to each datapoint 
         ) \
         .groupBy("TimeWindow", "Section_ID", "Lane_ID") \
         .agg(
@@ -328,8 +355,6 @@ def timewindow_agg(df: DataFrame, start: int, end: int, timewindow: int) -> Data
             F.round(F.avg("avg(v_Acc)"), 2).alias("avg(v_Acc)"), 
             F.count("*").alias("count")
         )
-    print("Time Window Aggregation Sample Result: ")
-    df.show(1)
     return df
 
 def add_timewindow_col(df: DataFrame, start: int, end: int, timewindow: int) -> DataFrame:
@@ -346,5 +371,5 @@ def add_timewindow_col(df: DataFrame, start: int, end: int, timewindow: int) ->
     return df \
         .filter((F.col("ElapsedTime") >= start * 1000) & (F.col("ElapsedTime") < end * 1000)) \
         .withColumn("TimeWindow", 
-            F.round((F.col("ElapsedTime") / F.lit(timewindow * 1000)).cast("integer")) # gives a TimeWindow ID of every n sec to each datapoint 
+            bucket_id(F.col("ElapsedTime"), timewindow * 1000) # gives a TimeWindow ID of every n sec to each datapoint 
         )
\ No newline at end of file
@@ -63,7 +63,7 @@ def visualise_shockwave(df: DataFrame, lane_id: int, max_dist: int, max_elapsed_
     max_elapsed_time: int, maximum elapsed time in ms
     """
 
-    pdf = df.toPandas()
+    pdf = df.orderBy("ElapsedTime").toPandas()
 
     vehicles = pdf.groupby("Vehicle_ID")
 
@@ -96,18 +96,18 @@ def visualise_shockwave(df: DataFrame, lane_id: int, max_dist: int, max_elapsed_
 
 def granular_snapshot(df: DataFrame, timestamp_ms: int) -> None:
     """
-    df: pyspark dataframe containing the US101 dataset with gps_geom column
+    df: pyspark dataframe containing the US101 dataset with lat and lon columns
     timestamp_ms: int, timestamp in milliseconds
     """
     snapshot_df = df \
-        .select("Location", "ElapsedTime", "Distance", "Vehicle_ID", "Lane_ID", "v_Vel", "v_Acc", "gps_geom") \
+        .select("Location", "ElapsedTime", "Distance", "Vehicle_ID", "Lane_ID", "v_Vel", "v_Acc", "lat", "lon") \
         .filter(
             (F.col("ElapsedTime") == timestamp_ms)
         ) \
         .sort("ElapsedTime")
 
     pdf_snapshot = snapshot_df.toPandas()
-    gdf_snapshot = gpd.GeoDataFrame(pdf_snapshot, geometry="gps_geom")
+    gdf_snapshot = gpd.GeoDataFrame(pdf_snapshot, geometry=gpd.points_from_xy(pdf_snapshot["lon"], pdf_snapshot["lat"]))
 
     gdf_snapshot.plot(
         figsize=(15, 15),